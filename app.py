@@ -2,8 +2,15 @@
 import streamlit as st
 import pandas as pd
 import io
-from typing import List, Set
-import re
+import os
+from typing import FrozenSet, List, Tuple
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import ahocorasick
+import openpyxl
+
+from surname_matching import build_substring_pattern, build_surname_automaton, process_file, surnames_set
 
 st.set_page_config(page_title="Surname Extractor — Master Sheet", layout="wide")
 
@@ -19,7 +26,7 @@ with st.expander("Instructions (open)", expanded=False):
 - Drag & drop up to 100 `.xlsx`, `.xls`, or `.csv` files in the file area.
 - App will attempt to auto-detect common surname column names (e.g., surname, last_name, family, lname) and pre-select them.
 - If names are in a full-name column, enable **Match only last-name token** to compare surname list to the last token of the name cell.
-- Choose exact or substring matching (case-insensitive).
+- Choose exact or substring matching (case-insensitive). Enable **Accent/case-insensitive match** to also ignore diacritics.
 - Preview results, remove duplicates, and download as Excel or CSV.
 - The app adds `__source_file` and `__sheet_name` columns for traceability.
 """
@@ -44,7 +51,7 @@ def load_surnames_from_file(f) -> List[str]:
     try:
         fname = getattr(f, "name", "surnames")
         if fname.lower().endswith(".xlsx"):
-            df = pd.read_excel(f, header=None)
+            df = pd.read_excel(f, header=None, engine="calamine")
             vals = df.stack().astype(str).tolist()
         else:
             # csv or txt
@@ -94,68 +101,94 @@ search_cols_input = st.text_input(
 exact_match = st.checkbox("Exact match (cell == surname)", value=True, key="exact_match")
 substring_match = st.checkbox("Substring match (cell contains surname)", value=False, key="substring_match")
 match_last_token = st.checkbox("Match only last-name token (use when full names are in one column)", value=False, key="match_last_token")
+fold_accents = st.checkbox("Accent/case-insensitive match (é = e, ß = ss)", value=False, key="fold_accents")
+prescreen_columns = st.checkbox(
+    "Skip columns that rarely contain surnames when searching all text columns (faster, but may miss rare matches)",
+    value=False,
+    key="prescreen_columns",
+)
 
 # Auto-detect common surname columns if available
 COMMON_SURNAME_COLS = [
     "surname","last_name","last name","lastname","family_name","family name","familyname",
     "lname","sur_name","sirname","surnames","last","lastname","name_last","family"
 ]
-def detect_surname_columns(df: pd.DataFrame):
+def detect_surname_columns(columns: List) -> List:
     cols = []
-    df_cols = [c.lower() for c in df.columns]
+    lowered = [str(c).lower() for c in columns]
     for candidate in COMMON_SURNAME_COLS:
-        if candidate in df_cols:
+        if candidate in lowered:
             # return original-case column name(s)
-            idx = df_cols.index(candidate)
-            cols.append(df.columns[idx])
+            idx = lowered.index(candidate)
+            cols.append(columns[idx])
     return cols
 
-def normalize_text(x):
-    try:
-        return str(x).strip().lower()
-    except Exception:
-        return ""
-
-def surnames_set(surnames: List[str]) -> Set[str]:
-    return set([s.strip().lower() for s in surnames if s and str(s).strip()])
-
-TARGET_SURNAMES = surnames_set(surnames_list)
-
-def last_name_token(text: str) -> str:
-    if not isinstance(text, str):
-        text = str(text)
-    # split on whitespace and common separators, keep last non-empty token
-    tokens = re.split(r"[\s,;/\\]+", text.strip())
-    tokens = [t for t in tokens if t]
-    return tokens[-1].lower() if tokens else ""
-
-def find_matches_in_dataframe(df: pd.DataFrame, search_columns: List[str], surnames: Set[str], exact: bool, substring: bool, last_token_only: bool):
-    if df.empty:
-        return pd.DataFrame()
-
-    df_copy = df.copy()
-    mask = pd.Series([False] * len(df_copy), index=df_copy.index)
-
-    if not search_columns:
-        text_cols = df_copy.select_dtypes(include=[object, "string"]).columns.tolist()
-    else:
-        text_cols = [c for c in search_columns if c in df_copy.columns]
-
-    # If last_token_only is True and there is exactly one column specified, we will extract last token for that column
-    for col in text_cols:
-        col_series = df_copy[col].fillna("").map(normalize_text)
-        if last_token_only:
-            # use last token of the original (not normalized) value to be safer with punctuation
-            col_series = df_copy[col].fillna("").map(last_name_token)
-
-        if exact:
-            mask = mask | col_series.isin(surnames)
-        if substring:
-            for s in surnames:
-                if not s:
-                    continue
-                mask = mask | col_series.str.contains(s, na=False)
-    return df_copy[mask]
+def sniff_header(f) -> List:
+    # read only the header row (first non-empty sheet for xlsx) instead of parsing the whole file
+    fname = getattr(f, "name", "file0").lower()
+    data = io.BytesIO(f.getvalue())
+    if fname.endswith(".csv"):
+        return pd.read_csv(data, nrows=0).columns.tolist()
+    if fname.endswith(".xlsx"):
+        wb = openpyxl.load_workbook(data, read_only=True)
+        try:
+            for ws in wb.worksheets:
+                header = next(ws.iter_rows(max_row=1, values_only=True), None)
+                if header and any(v is not None for v in header):
+                    return [v for v in header if v is not None]
+        finally:
+            wb.close()
+        return []
+    return pd.read_excel(data, sheet_name=0, nrows=0, engine="calamine").columns.tolist()
+
+def get_surname_index(surnames: List[str], fold: bool) -> Tuple[FrozenSet[str], ahocorasick.Automaton, str]:
+    # widget changes rerun the whole script; only normalize the surnames, build the automaton and
+    # the alternation again when the list content (or accent folding) actually changed
+    key = hashlib.md5("\n".join(surnames + [f"fold={fold}"]).encode("utf-8")).hexdigest()
+    if st.session_state.get("surname_index_key") != key:
+        targets = surnames_set(surnames, fold)
+        st.session_state["surname_index"] = (targets, build_surname_automaton(targets), build_substring_pattern(targets))
+        st.session_state["surname_index_key"] = key
+    return st.session_state["surname_index"]
+
+TARGET_SURNAMES, SURNAME_AUTOMATON, SUBSTRING_PATTERN = get_surname_index(surnames_list, fold_accents)
+
+def drop_duplicate_rows(chunks: List[pd.DataFrame], columns: List[str]) -> List[pd.DataFrame]:
+    # row keys remembered across chunks instead of concatenating everything for drop_duplicates;
+    # keys hold the Python values themselves, so 123 and "123" stay distinct and missing values match
+    seen = set()
+    deduped = []
+    for chunk in chunks:
+        keep = []
+        for row in chunk.reindex(columns=columns).itertuples(index=False, name=None):
+            key = tuple(None if pd.isna(v) else v for v in row)
+            keep.append(key not in seen)
+            seen.add(key)
+        if any(keep):
+            deduped.append(chunk[keep])
+    return deduped
+
+# The master sheet is written chunk by chunk (one chunk per matched sheet) instead of from one concatenated frame.
+def write_master_csv(chunks: List[pd.DataFrame], columns: List[str]) -> bytes:
+    buffer = io.BytesIO()
+    for i, chunk in enumerate(chunks):
+        chunk.reindex(columns=columns).to_csv(buffer, index=False, header=(i == 0), encoding="utf-8")
+    return buffer.getvalue()
+
+def write_master_xlsx(chunks: List[pd.DataFrame], columns: List[str]) -> bytes:
+    buffer = io.BytesIO()
+    options = {"constant_memory": True, "default_date_format": "yyyy-mm-dd hh:mm:ss"}
+    with pd.ExcelWriter(buffer, engine="xlsxwriter", engine_kwargs={"options": options}) as writer:
+        # constant_memory flushes each finished row, so rows are written strictly in order with write_row
+        # (DataFrame.to_excel writes column by column and would lose data in this mode)
+        worksheet = writer.book.add_worksheet("master")
+        worksheet.write_row(0, 0, [str(c) for c in columns], writer.book.add_format({"bold": True}))
+        row_idx = 1
+        for chunk in chunks:
+            for row in chunk.reindex(columns=columns).itertuples(index=False, name=None):
+                worksheet.write_row(row_idx, 0, [None if pd.isna(v) else v for v in row])
+                row_idx += 1
+    return buffer.getvalue()
 
 # ---------- Main processing ----------
 if uploaded_files and surnames_list:
@@ -171,97 +204,82 @@ if uploaded_files and surnames_list:
 
     # parsed user specified columns
     search_columns = [c.strip() for c in search_cols_input.split(",") if c.strip()]
+    # only columns typed by the user switch .xlsx files to the low-memory streaming reader
+    stream_xlsx = bool(search_columns)
 
     # If search_columns empty, attempt to auto-detect from the first sheet/file
     if not search_columns and uploaded_files:
-        # peek into first file to detect common surname-like columns
-        first = uploaded_files[0]
-        fname = getattr(first, "name", "file0")
+        # sniff the first file's header row to detect common surname-like columns
         try:
-            if fname.lower().endswith(".csv"):
-                peek_df = pd.read_csv(first, nrows=50)
-            else:
-                first.seek(0)
-                sheets = pd.read_excel(first, sheet_name=None)
-                # pick first non-empty sheet
-                peek_df = None
-                for sn, d in sheets.items():
-                    if d is not None and not d.empty:
-                        peek_df = d.head(50)
-                        break
-                if peek_df is None:
-                    peek_df = pd.DataFrame()
+            header = sniff_header(uploaded_files[0])
         except Exception:
-            try:
-                first.seek(0)
-            except Exception:
-                pass
-            peek_df = pd.DataFrame()
+            header = []
 
-        detected = detect_surname_columns(peek_df) if not peek_df.empty else []
+        detected = detect_surname_columns(header)
         if detected:
             # pre-fill search_columns with detected surname-like columns
             search_columns = detected
             st.info(f"Auto-detected surname column(s): {', '.join(detected)} — pre-selected.")
 
-    for i, f in enumerate(uploaded_files):
-        fname = getattr(f, "name", f"file_{i}")
-        try:
-            if fname.lower().endswith(".csv"):
-                df = pd.read_csv(f)
-                total_checked_rows += len(df)
-                matched = find_matches_in_dataframe(df, search_columns, TARGET_SURNAMES, exact_match, substring_match, match_last_token)
-                if not matched.empty:
-                    matched["__source_file"] = fname
-                    matched["__sheet_name"] = "<csv>"
-                    results.append(matched)
-            else:
-                try:
-                    sheets = pd.read_excel(f, sheet_name=None)
-                except Exception:
-                    f.seek(0)
-                    sheets = {"Sheet1": pd.read_excel(f)}
-                for sheet_name, df in sheets.items():
-                    if df is None or df.empty:
-                        continue
-                    total_checked_rows += len(df)
-                    # if we have no explicit search_columns but matched was auto-detected earlier, use those; otherwise search all text columns
-                    matched = find_matches_in_dataframe(df, search_columns, TARGET_SURNAMES, exact_match, substring_match, match_last_token)
-                    if not matched.empty:
-                        matched["__source_file"] = fname
-                        matched["__sheet_name"] = sheet_name
-                        results.append(matched)
-
-        except Exception as e:
-            st.error(f"Failed to process {fname}: {e}")
-
-        progress_bar.progress((i + 1) / len(uploaded_files))
+    # workers get raw bytes and picklable settings; results are kept in upload order
+    jobs = [(getattr(f, "name", f"file_{i}"), f.getvalue()) for i, f in enumerate(uploaded_files)]
+    file_results = [None] * len(jobs)
+    # spawn, not fork: forking the multi-threaded Streamlit server can deadlock the children;
+    # the workers only need surname_matching, which imports cleanly in a fresh interpreter
+    with ProcessPoolExecutor(
+        max_workers=min(len(jobs), os.cpu_count() or 1), mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        futures = {
+            executor.submit(
+                process_file, data, fname, search_columns, TARGET_SURNAMES,
+                exact_match, substring_match, match_last_token, SURNAME_AUTOMATON, SUBSTRING_PATTERN, fold_accents, prescreen_columns, stream_xlsx,
+            ): i
+            for i, (fname, data) in enumerate(jobs)
+        }
+        for done, future in enumerate(as_completed(futures), start=1):
+            i = futures[future]
+            try:
+                file_results[i] = future.result()
+            except Exception as e:
+                st.error(f"Failed to process {jobs[i][0]}: {e}")
+            progress_bar.progress(done / len(jobs))
+
+    for file_result in file_results:
+        if file_result is None:
+            continue
+        matched_frames, checked_rows = file_result
+        results.extend(matched_frames)
+        total_checked_rows += checked_rows
 
     if results:
-        combined = pd.concat(results, ignore_index=True)
-        combined = combined.drop_duplicates().reset_index(drop=True)
+        master_columns = list(dict.fromkeys(c for chunk in results for c in chunk.columns))
+        results = drop_duplicate_rows(results, master_columns)
+        total_matched_rows = sum(len(chunk) for chunk in results)
 
-        st.success(f"Found {len(combined)} matching rows across files (checked ~{total_checked_rows} rows).")
+        st.success(f"Found {total_matched_rows} matching rows across files (checked ~{total_checked_rows} rows).")
 
         with st.expander("Preview first 200 matched rows", expanded=True):
-            st.dataframe(combined.head(200))
+            preview_chunks = []
+            preview_rows = 0
+            for chunk in results:
+                preview_chunks.append(chunk.head(200 - preview_rows))
+                preview_rows += len(preview_chunks[-1])
+                if preview_rows >= 200:
+                    break
+            st.dataframe(pd.concat(preview_chunks, ignore_index=True).reindex(columns=master_columns))
 
         to_download_format = st.radio("Download format:", ("xlsx", "csv"), horizontal=True)
         if to_download_format == "xlsx":
-            buffer = io.BytesIO()
-            with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
-                combined.to_excel(writer, index=False, sheet_name="master")
             st.download_button(
                 label="📥 Download Master Excel",
-                data=buffer.getvalue(),
+                data=write_master_xlsx(results, master_columns),
                 file_name="master_surnames_master.xlsx",
                 mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
             )
         else:
-            csv_bytes = combined.to_csv(index=False).encode("utf-8")
             st.download_button(
                 label="📥 Download Master CSV",
-                data=csv_bytes,
+                data=write_master_csv(results, master_columns),
                 file_name="master_surnames_master.csv",
                 mime="text/csv",
             )
@@ -278,4 +296,4 @@ else:
         st.warning("Please upload data files to process.")
 
 st.markdown("---")
-st.markdown("**Tips:** If your surname column has leading/trailing spaces or mixed-case, this app will normalize before matching. For full-name columns, enable 'Match only last-name token' to compare the final token. If you need accent-insensitive matching, augment `normalize_text()` to remove diacritics.")
+st.markdown("**Tips:** If your surname column has leading/trailing spaces or mixed-case, this app will normalize before matching. For full-name columns, enable 'Match only last-name token' to compare the final token. If names are spelled with and without accents (e.g. José / Jose), enable 'Accent/case-insensitive match'.")
@@ -0,0 +1,285 @@
+# surname_matching.py
+# Matching helpers shared by app.py and its worker processes; keep this module free of Streamlit calls.
+import io
+import re
+import sys
+import unicodedata
+from functools import lru_cache
+from typing import FrozenSet, List, Tuple
+
+import ahocorasick
+import numpy as np
+import openpyxl
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+def fold_text(text: str) -> str:
+    # NFKD splits accented letters into base letter + combining mark; dropping the marks turns "é" into "e"
+    return "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c)).casefold()
+
+@lru_cache(maxsize=200_000, typed=True)
+def _normalize_cached(x, fold: bool) -> str:
+    text = str(x).strip().lower()
+    # interned so repeated cells and the target surnames share one object
+    return sys.intern(fold_text(text) if fold else text)
+
+def normalize_text(x, fold: bool = False):
+    # the same cell values repeat across columns and files, so memoize the strip/lower (and accent folding)
+    try:
+        return _normalize_cached(x, fold)
+    except TypeError:
+        # unhashable cell value, normalize without the cache
+        pass
+    except Exception:
+        return ""
+    try:
+        text = str(x).strip().lower()
+        return fold_text(text) if fold else text
+    except Exception:
+        return ""
+
+def surnames_set(surnames: List[str], fold: bool = False) -> FrozenSet[str]:
+    return frozenset(normalize_text(s, fold) for s in surnames if s and str(s).strip())
+
+def build_surname_automaton(surnames: FrozenSet[str]) -> ahocorasick.Automaton:
+    # one automaton finds every surname in a single pass over a cell
+    automaton = ahocorasick.Automaton()
+    for s in surnames:
+        automaton.add_word(s, s)
+    automaton.make_automaton()
+    return automaton
+
+def build_substring_pattern(surnames: FrozenSet[str]) -> str:
+    # one alternation for all surnames, longest first so the engine settles on long matches quickly
+    return "|".join(sorted(map(re.escape, surnames), key=len, reverse=True))
+
+def last_name_token(text: str) -> str:
+    if not isinstance(text, str):
+        text = str(text)
+    # split on whitespace and common separators, keep last non-empty token
+    tokens = re.split(r"[\s,;/\\]+", text.strip())
+    tokens = [t for t in tokens if t]
+    return tokens[-1].lower() if tokens else ""
+
+# last run of non-separator characters, ignoring trailing separators; same split as last_name_token()
+LAST_TOKEN_PATTERN = r"([^\s,;/\\]+)[\s,;/\\]*$"
+
+def last_name_tokens(series: pd.Series, fold: bool = False) -> pd.Series:
+    # vectorized last_name_token(): one compiled regex pass over the whole column
+    # cast before filling: Arrow numeric/null columns cannot hold ""; missing cells are filled below
+    tokens = series.astype("string[pyarrow]").str.extract(LAST_TOKEN_PATTERN, expand=False)
+    tokens = tokens.str.lower().fillna("")
+    if fold:
+        tokens = tokens.map(lambda t: normalize_text(t, fold=True))
+    return tokens
+
+def exact_mask(values: List[str], surnames: FrozenSet[str]) -> np.ndarray:
+    # one pass over the column, writing straight into a preallocated bool array
+    return np.fromiter(map(surnames.__contains__, values), dtype=bool, count=len(values))
+
+def raw_exact_mask(values: np.ndarray, surnames: FrozenSet[str], fold: bool = False) -> np.ndarray:
+    # normalize straight from the raw cells; missing and non-text cells never match
+    return np.fromiter(
+        (isinstance(v, str) and normalize_text(v, fold) in surnames for v in values), dtype=bool, count=len(values)
+    )
+
+def category_exact_mask(series: pd.Series, surnames: FrozenSet[str], fold: bool = False) -> np.ndarray:
+    # match each distinct value once, then broadcast the result back through the category codes
+    # via object: Arrow null/numeric columns can't be turned into categories directly
+    categorical = series.astype(object).astype("category")
+    hits = raw_exact_mask(categorical.cat.categories.to_numpy(dtype=object), surnames, fold)
+    # missing cells have code -1, which picks up the trailing False
+    return np.append(hits, False)[categorical.cat.codes.to_numpy()]
+
+def is_arrow_string(series: pd.Series) -> bool:
+    return isinstance(series.dtype, pd.ArrowDtype) and (
+        pa.types.is_string(series.dtype.pyarrow_dtype) or pa.types.is_large_string(series.dtype.pyarrow_dtype)
+    )
+
+def arrow_string_mask(series: pd.Series, surnames: FrozenSet[str], exact: bool, substring: bool, substring_pattern: str) -> np.ndarray:
+    # Arrow-backed columns are normalized and matched with Arrow compute kernels, no per-cell Python
+    values = pc.utf8_lower(pc.utf8_trim_whitespace(pc.fill_null(pa.array(series), "")))
+    mask = np.zeros(len(series), dtype=bool)
+    if exact:
+        mask |= pc.is_in(values, value_set=pa.array(sorted(surnames), pa.string())).to_numpy(zero_copy_only=False)
+    if substring:
+        mask |= pc.match_substring_regex(values, pattern=substring_pattern).to_numpy(zero_copy_only=False)
+    return mask
+
+def is_arrow_unsearchable(series: pd.Series) -> bool:
+    # all-empty (null) and undecoded (binary) Arrow columns can never hold a surname
+    if not isinstance(series.dtype, pd.ArrowDtype):
+        return False
+    t = series.dtype.pyarrow_dtype
+    return pa.types.is_null(t) or pa.types.is_binary(t) or pa.types.is_large_binary(t)
+
+def resolve_search_columns(df: pd.DataFrame, search_columns: List[str]) -> List[str]:
+    # the requested columns present in this frame, or every text column when none were requested
+    if not search_columns:
+        object_cols = set(df.select_dtypes(include=[object, "string"]).columns)
+        return [c for c in df.columns if c in object_cols or is_arrow_string(df[c])]
+    return [c for c in search_columns if c in df.columns and not is_arrow_unsearchable(df[c])]
+
+def read_csv_bytes(file_bytes: bytes) -> pd.DataFrame:
+    # pyarrow parses much faster, but rejects short rows, keeps repeated headers as-is and loads
+    # non-UTF-8 text as binary; those files go through pandas' default reader instead
+    try:
+        df = pd.read_csv(io.BytesIO(file_bytes), engine="pyarrow", dtype_backend="pyarrow")
+    except (pa.ArrowInvalid, ValueError):
+        return pd.read_csv(io.BytesIO(file_bytes))
+    if df.columns.has_duplicates or any(
+        pa.types.is_binary(t) or pa.types.is_large_binary(t)
+        for t in (dtype.pyarrow_dtype for dtype in df.dtypes if isinstance(dtype, pd.ArrowDtype))
+    ):
+        return pd.read_csv(io.BytesIO(file_bytes))
+    return df
+
+# column pre-screen: how many leading values to sample, and the share that must look like surnames
+PRESCREEN_SAMPLE_SIZE = 256
+PRESCREEN_MIN_HIT_RATE = 0.01
+
+def column_may_match(series: pd.Series, surnames: FrozenSet[str], substring: bool, automaton: ahocorasick.Automaton, fold: bool = False) -> bool:
+    # cheap early rejection for columns like cities, emails or dates stored as text
+    sample = series.dropna().head(PRESCREEN_SAMPLE_SIZE).tolist()
+    hits = 0
+    for value in sample:
+        text = normalize_text(value, fold)
+        if any(t in surnames for t in re.split(r"[\s,;/\\]+", text) if t):
+            hits += 1
+        elif substring and surnames and next(automaton.iter(text), None) is not None:
+            hits += 1
+    return bool(sample) and hits >= PRESCREEN_MIN_HIT_RATE * len(sample)
+
+def find_matches_in_dataframe(df: pd.DataFrame, text_cols: List[str], surnames: FrozenSet[str], exact: bool, substring: bool, last_token_only: bool, automaton: ahocorasick.Automaton, substring_pattern: str, fold: bool = False, prescreen: bool = False):
+    if df.empty:
+        return pd.DataFrame()
+
+    mask = np.zeros(len(df), dtype=bool)
+    substring_cols = []
+    # If last_token_only is True and there is exactly one column specified, we will extract last token for that column
+    for col in text_cols:
+        if prescreen and not column_may_match(df[col], surnames, substring, automaton, fold):
+            continue
+        # Arrow has no casefold, so accent-folded matching takes the Python path below
+        if not last_token_only and not fold and is_arrow_string(df[col]):
+            mask |= arrow_string_mask(df[col], surnames, exact, substring and bool(surnames), substring_pattern)
+            continue
+        if exact and not substring and not last_token_only:
+            # exact-only (the default): skip building a normalized Series for the column
+            n_unique = df[col].nunique(dropna=True)
+            if n_unique == 0:
+                # every cell is missing, nothing to match
+                continue
+            if n_unique < len(df) // 4:
+                # heavily repeated values (cities, departments, ...): compare the distinct values only
+                mask |= category_exact_mask(df[col], surnames, fold)
+            else:
+                mask |= raw_exact_mask(df[col].to_numpy(dtype=object), surnames, fold)
+            continue
+
+        if last_token_only:
+            # use last token of the original (not normalized) value to be safer with punctuation
+            col_series = last_name_tokens(df[col], fold)
+        else:
+            # object first: Arrow numeric/null columns cannot hold the "" fill value
+            col_series = df[col].astype(object).fillna("").map(lambda v: normalize_text(v, fold))
+
+        if exact:
+            mask |= exact_mask(col_series.tolist(), surnames)
+        if substring and surnames:
+            substring_cols.append(col_series.to_numpy())
+
+    # substring: a single pass over the rows checks every column against the automaton
+    for row_idx, row in enumerate(zip(*substring_cols)):
+        if not mask[row_idx] and any(next(automaton.iter(v), None) is not None for v in row):
+            mask[row_idx] = True
+    return df[mask]
+
+def stream_xlsx_matches(file_bytes: bytes, fname: str, search_columns: List[str], surnames: FrozenSet[str], exact: bool, substring: bool, last_token_only: bool, automaton: ahocorasick.Automaton, fold: bool = False) -> Tuple[List[pd.DataFrame], int]:
+    # walk the workbook row by row and keep only matching rows, so memory grows with matches rather than sheet size
+    def cell_matches(value) -> bool:
+        if value is None:
+            return False
+        key = normalize_text(last_name_token(value), fold) if last_token_only else normalize_text(value, fold)
+        if exact and key in surnames:
+            return True
+        return bool(substring and surnames and next(automaton.iter(key), None) is not None)
+
+    results = []
+    checked_rows = 0
+    wb = openpyxl.load_workbook(io.BytesIO(file_bytes), read_only=True, data_only=True)
+    try:
+        for ws in wb.worksheets:
+            # stored sheet dimensions are sometimes wrong and would truncate rows or columns
+            ws.reset_dimensions()
+            rows = ws.iter_rows(values_only=True)
+            header = next(rows, None)
+            if header is None:
+                continue
+            # name columns the way pandas would: blank headers become "Unnamed: i", repeats get a ".n" suffix
+            columns = []
+            seen = {}
+            for i, name in enumerate(header):
+                name = f"Unnamed: {i}" if name is None else name
+                if name in seen:
+                    seen[name] += 1
+                    name = f"{name}.{seen[name]}"
+                else:
+                    seen[name] = 0
+                columns.append(name)
+            targets = [i for i, c in enumerate(columns) if c in search_columns]
+
+            matched_rows = []
+            for row in rows:
+                if all(v is None for v in row):
+                    continue
+                checked_rows += 1
+                if any(cell_matches(row[i]) for i in targets if i < len(row)):
+                    matched_rows.append(row)
+            if matched_rows:
+                matched = pd.DataFrame(matched_rows, columns=columns)
+                results.append(matched.assign(__source_file=fname, __sheet_name=ws.title))
+    finally:
+        wb.close()
+    return results, checked_rows
+
+def process_file(file_bytes: bytes, fname: str, search_columns: List[str], surnames: FrozenSet[str], exact: bool, substring: bool, last_token_only: bool, automaton: ahocorasick.Automaton, substring_pattern: str, fold: bool = False, prescreen: bool = False, stream_xlsx: bool = False) -> Tuple[List[pd.DataFrame], int]:
+    # runs in a worker process: takes raw bytes because Streamlit upload handles don't pickle
+    # unpickled strings are not interned, so re-intern the surnames for this process
+    surnames = frozenset(map(sys.intern, surnames))
+    # the pre-screen only thins out the all-text-columns search, never columns the user asked for
+    prescreen = prescreen and not search_columns
+    results = []
+    checked_rows = 0
+    if fname.lower().endswith(".csv"):
+        df = read_csv_bytes(file_bytes)
+        checked_rows += len(df)
+        text_cols = resolve_search_columns(df, search_columns)
+        matched = find_matches_in_dataframe(df, text_cols, surnames, exact, substring, last_token_only, automaton, substring_pattern, fold, prescreen)
+        if not matched.empty:
+            results.append(matched.assign(__source_file=fname, __sheet_name="<csv>"))
+    elif stream_xlsx and search_columns and fname.lower().endswith(".xlsx"):
+        # the user named the columns to check, so the workbook can be streamed instead of loaded;
+        # openpyxl's pure-Python reader is slower than calamine, so auto-detected columns don't take this path
+        return stream_xlsx_matches(file_bytes, fname, search_columns, surnames, exact, substring, last_token_only, automaton, fold)
+    else:
+        # calamine parses .xlsx and .xls natively; sheets are parsed one at a time and dropped once
+        # matched, so peak memory is the largest sheet rather than the whole workbook
+        # template workbooks repeat one schema across sheets, so resolve the columns once per schema;
+        # dtypes are part of the key because the all-text-columns search depends on them
+        resolved_cols = {}
+        with pd.ExcelFile(io.BytesIO(file_bytes), engine="calamine") as xls:
+            for sheet_name in xls.sheet_names:
+                df = xls.parse(sheet_name)
+                if df is None or df.empty:
+                    continue
+                checked_rows += len(df)
+                # if we have no explicit search_columns but matched was auto-detected earlier, use those; otherwise search all text columns
+                schema = (tuple(df.columns), tuple(df.dtypes))
+                if schema not in resolved_cols:
+                    resolved_cols[schema] = resolve_search_columns(df, search_columns)
+                matched = find_matches_in_dataframe(df, resolved_cols[schema], surnames, exact, substring, last_token_only, automaton, substring_pattern, fold, prescreen)
+                if not matched.empty:
+                    results.append(matched.assign(__source_file=fname, __sheet_name=sheet_name))
+    return results, checked_rows
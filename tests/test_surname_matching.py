@@ -0,0 +1,36 @@
+# tests/test_surname_matching.py
+import pytest
+
+from surname_matching import build_substring_pattern, build_surname_automaton, process_file, surnames_set
+
+
+def run(csv_bytes, search_columns=(), exact=True, substring=False, last_token_only=False):
+    surnames = surnames_set(["Jain", "Shah"])
+    automaton = build_surname_automaton(surnames)
+    pattern = build_substring_pattern(surnames)
+    results, checked_rows = process_file(
+        csv_bytes, "a.csv", list(search_columns), surnames, exact, substring, last_token_only, automaton, pattern
+    )
+    return sum(len(df) for df in results), checked_rows
+
+
+def test_empty_csv_column_with_low_cardinality_exact_search():
+    # the empty Notes column loads as null[pyarrow]; City repeats enough to take the category path
+    rows = "".join(f"{name},Pune,\n" for name in ["Jain", "P1", "P2", "P3", "P4", "Shah", "P5", "P6", "P7", "P8"])
+    matched, checked = run(("Name,City,Notes\n" + rows).encode())
+    assert (matched, checked) == (2, 10)
+
+
+def test_repeated_csv_headers_are_mangled():
+    matched, checked = run(b"Name,Name,Id\nJain,a,1\nb,Shah,2\n", search_columns=["Name.1"])
+    assert (matched, checked) == (1, 2)
+
+
+def test_csv_rows_with_missing_trailing_fields():
+    matched, checked = run(b"Name,City,Id\nJain,Pune\nShah,Pune,3\n")
+    assert (matched, checked) == (2, 2)
+
+
+def test_non_utf8_csv_fails_loudly():
+    with pytest.raises(UnicodeDecodeError):
+        run("Name,City\nJain,Köln\n".encode("latin-1"))